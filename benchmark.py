@@ -0,0 +1,389 @@
+"""
+核心热点路径的微基准测试。
+
+使用假的WebSocket和桩数据库，确定性地测量消息转发、消息验证、房间成员查询、
+房间成员变更（含成员列表日志）以及消息封包编码的单次耗时。
+
+用法:
+    python benchmark.py                      # 运行并输出结果
+    python benchmark.py --save               # 运行并保存为基线
+    python benchmark.py --compare            # 与基线比较，回归超过阈值时返回非零退出码
+    python benchmark.py --compare --threshold 0.1
+    python benchmark.py --only validate_message encode_envelope   # 只运行指定的基准
+"""
+import argparse
+import asyncio
+import datetime
+import gc
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import db_manager
+import message_handler
+import room_manager
+
+DEFAULT_BASELINE = "benchmark_baseline.json"
+DEFAULT_THRESHOLD = 0.2
+
+# 房间规模
+ROOM_SIZES = [2, 10, 100, 1000, 5000]
+
+# 每次重复至少运行的时间（秒）与重复次数；以最快一次作为结果，中位数相对最快一次的偏差作为噪声
+MIN_REPEAT_TIME = 0.05
+REPEATS = 11
+
+# 疑似回归的基准最多重新测量的轮数及每轮之前的等待时间（秒）。
+# 机器负载造成的变慢往往持续数十秒，每轮间隔一段时间并在新进程中测量，取各轮中最快的结果；
+# 真实回归会持续存在，负载波动则不会
+CONFIRM_RUNS = 5
+CONFIRM_DELAY = 10
+
+BENCH_ROOM_ID = "BENCH001"
+
+
+class FakeWebSocket:
+    """只记录发送字节数的假WebSocket"""
+
+    def __init__(self):
+        self.sent_bytes = 0
+
+    async def send(self, data):
+        self.sent_bytes += len(data)
+
+
+async def stub_write(statements):
+    """桩数据库写入：不访问数据库，直接返回递增的行ID"""
+    stub_write.last_id += 1
+    return [stub_write.last_id] * len(statements)
+
+
+stub_write.last_id = 0
+
+
+def setup_environment():
+    """替换数据库写入并让日志走完格式化之外的完整路径，但不输出"""
+    db_manager.write = stub_write
+
+    logger = logging.getLogger("websocket_server")
+    logger.handlers = [logging.NullHandler()]
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+    random.seed(0)
+
+
+def populate_room(size):
+    """创建包含 size 个客户端的基准房间，返回房间中的客户端字典"""
+    room_manager.rooms[BENCH_ROOM_ID] = {
+        cid: {"websocket": FakeWebSocket(), "identity": "bench", "device_id": f"device_{cid}"}
+        for cid in range(size)
+    }
+    return room_manager.rooms[BENCH_ROOM_ID]
+
+
+def sample_message(target_device_id=None):
+    """构造一条典型的客户端消息"""
+    message = {
+        "type": "message",
+        "content": "Hello everyone in the room!",
+        "timestamp": "2024-01-20T12:34:56Z"
+    }
+    if target_device_id:
+        message["target_device_id"] = target_device_id
+    return message
+
+
+def measure(loop, operation):
+    """
+    测量单次操作耗时。
+    operation 接收运行次数，是返回协程的函数或普通函数。
+    返回 {"min": 纳秒, "median": 纳秒, "spread": 中位数相对最快一次的偏差比例}
+    """
+    def run(number):
+        start = time.perf_counter()
+        result = operation(number)
+        if asyncio.iscoroutine(result):
+            loop.run_until_complete(result)
+        return time.perf_counter() - start
+
+    # 与timeit一样在计时期间关闭垃圾回收，避免回收时机带来的抖动
+    gc_enabled = gc.isenabled()
+    gc.collect()
+    gc.disable()
+    try:
+        # 校准运行次数，使每次重复至少运行 MIN_REPEAT_TIME 秒
+        number = 1
+        while run(number) < MIN_REPEAT_TIME:
+            number *= 2
+
+        # 预热一次后再正式计时
+        run(number)
+        timings = sorted(run(number) / number * 1e9 for _ in range(REPEATS))
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    best = timings[0]
+    median = statistics.median(timings)
+    return {"min": best, "median": median, "spread": median / best - 1}
+
+
+def bench_forward_broadcast(size):
+    populate_room(size)
+    message = sample_message()
+
+    async def operation(number):
+        for _ in range(number):
+            await message_handler.forward_message(message, BENCH_ROOM_ID, 0, "device_0")
+
+    return operation
+
+
+def bench_forward_direct(size):
+    # 目标设备位于房间末尾，测量最坏情况的查找
+    populate_room(size)
+    message = sample_message(f"device_{size - 1}")
+
+    async def operation(number):
+        for _ in range(number):
+            await message_handler.forward_message(message, BENCH_ROOM_ID, 0, "device_0")
+
+    return operation
+
+
+def bench_validate_message():
+    message = sample_message()
+
+    async def operation(number):
+        for _ in range(number):
+            await message_handler.validate_message(message)
+
+    return operation
+
+
+def bench_get_room_clients(size):
+    populate_room(size)
+
+    def operation(number):
+        for _ in range(number):
+            room_manager.get_room_clients(BENCH_ROOM_ID, 0)
+
+    return operation
+
+
+def bench_add_remove_client(size):
+    # 房间中已有 size - 1 个客户端，测量一次加入和离开
+    populate_room(size - 1)
+    websocket = FakeWebSocket()
+
+    def operation(number):
+        for _ in range(number):
+            room_manager.add_client_to_room(BENCH_ROOM_ID, -1, websocket, "bench", "device_new")
+            room_manager.remove_client_from_room(BENCH_ROOM_ID, -1)
+
+    return operation
+
+
+def bench_encode_envelope():
+    outgoing_message = {
+        "type": "message",
+        "content": "Hello everyone in the room!",
+        "from_device_id": "device_0",
+        "message_type": "broadcast",
+        "timestamp": "2024-01-20T12:34:56Z"
+    }
+
+    def operation(number):
+        for _ in range(number):
+            json.dumps(outgoing_message)
+
+    return operation
+
+
+def collect_benchmarks():
+    """返回 (名称, 构造函数) 列表，构造函数返回被测操作"""
+    benchmarks = []
+    for size in ROOM_SIZES:
+        benchmarks.append((f"forward_message.broadcast[{size}]", lambda s=size: bench_forward_broadcast(s)))
+        benchmarks.append((f"forward_message.direct[{size}]", lambda s=size: bench_forward_direct(s)))
+    benchmarks.append(("validate_message", bench_validate_message))
+    for size in ROOM_SIZES:
+        benchmarks.append((f"get_room_clients[{size}]", lambda s=size: bench_get_room_clients(s)))
+    for size in ROOM_SIZES:
+        benchmarks.append((f"add_remove_client[{size}]", lambda s=size: bench_add_remove_client(s)))
+    benchmarks.append(("encode_envelope", bench_encode_envelope))
+    return benchmarks
+
+
+def run_benchmarks(names=None):
+    """运行全部（或 names 指定的）基准，返回 {名称: measure() 的结果}"""
+    setup_environment()
+    loop = asyncio.new_event_loop()
+    results = {}
+    try:
+        for name, build in collect_benchmarks():
+            if names is not None and name not in names:
+                continue
+            results[name] = measure(loop, build())
+            room_manager.rooms.pop(BENCH_ROOM_ID, None)
+            print(f"{name:<40} {format_ns(results[name]['min']):>12} {results[name]['spread']:>8.1%} noise")
+    finally:
+        loop.close()
+    return results
+
+
+def format_ns(value):
+    """格式化纳秒耗时"""
+    if value >= 1e6:
+        return f"{value / 1e6:.2f} ms"
+    if value >= 1e3:
+        return f"{value / 1e3:.2f} us"
+    return f"{value:.0f} ns"
+
+
+def save_baseline(results, path):
+    """将结果保存为基线文件"""
+    baseline = {
+        "created_at": datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "unit": "ns/op",
+        "repeats": REPEATS,
+        "results": results
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+    print(f"Saved baseline with {len(results)} benchmarks to {path}")
+
+
+def load_baseline(path):
+    """读取基线文件，文件不存在或格式不正确时返回None"""
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)["results"]
+    except FileNotFoundError:
+        print(f"Baseline file {path} not found, run with --save first", file=sys.stderr)
+    except (ValueError, KeyError, TypeError) as e:
+        print(f"Invalid baseline file {path}: {e}", file=sys.stderr)
+    return None
+
+
+def find_regressions(results, baseline, threshold):
+    """返回最快一次耗时变慢超过 threshold 的基准名称列表"""
+    return [
+        name for name, current in results.items()
+        if name in baseline and current["min"] / baseline[name]["min"] - 1 > threshold
+    ]
+
+
+def is_noisy(baseline_entry, current, threshold):
+    """两次运行中较大的噪声是否超过 threshold（此时比较结果不可靠）"""
+    return max(baseline_entry["spread"], current["spread"]) > threshold
+
+
+def run_in_subprocess(names):
+    """在新的解释器进程中运行指定的基准，返回 {名称: measure() 的结果}"""
+    with tempfile.TemporaryDirectory() as tempdir:
+        path = os.path.join(tempdir, "results.json")
+        subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--save", "--baseline", path, "--only", *names],
+            check=True
+        )
+        return load_baseline(path) or {}
+
+
+def confirm_regressions(results, baseline, threshold):
+    """
+    分多轮重新测量疑似回归的基准并保留最快的结果，返回仍然回归的基准名称列表。
+    各轮结果之间的偏差同样计入噪声，使机器负载波动造成的回归在对比表中标记为 NOISY。
+    """
+    regressions = find_regressions(results, baseline, threshold)
+    samples = {name: [results[name]["min"]] for name in regressions}
+    for _ in range(CONFIRM_RUNS):
+        if not regressions:
+            break
+        print(f"\nRe-measuring {len(regressions)} suspected regression(s) in {CONFIRM_DELAY}s")
+        time.sleep(CONFIRM_DELAY)
+        for name, current in run_in_subprocess(regressions).items():
+            samples[name].append(current["min"])
+            if current["min"] < results[name]["min"]:
+                results[name] = current
+            rounds_spread = statistics.median(samples[name]) / min(samples[name]) - 1
+            results[name]["spread"] = max(results[name]["spread"], rounds_spread)
+        regressions = find_regressions(results, baseline, threshold)
+    return regressions
+
+
+def compare_baseline(results, baseline, threshold):
+    """
+    与基线比较最快一次的耗时并输出对比表，返回回归的基准名称列表。
+    变慢超过 threshold 即视为回归；噪声超过 threshold 的基准会给出警告。
+    """
+    regressions = find_regressions(results, baseline, threshold)
+    noisy = []
+    print(f"\n{'benchmark':<40} {'baseline':>12} {'current':>12} {'change':>9} {'noise':>9}")
+    for name, current in results.items():
+        if name not in baseline:
+            print(f"{name:<40} {'-':>12} {format_ns(current['min']):>12} {'new':>9}")
+            continue
+
+        change = current["min"] / baseline[name]["min"] - 1
+        noise = max(baseline[name]["spread"], current["spread"])
+        marker = ""
+        if name in regressions:
+            marker = "  REGRESSION"
+        if is_noisy(baseline[name], current, threshold):
+            noisy.append(name)
+            marker += "  NOISY"
+        print(f"{name:<40} {format_ns(baseline[name]['min']):>12} {format_ns(current['min']):>12} "
+              f"{change:>+8.1%} {noise:>8.1%}{marker}")
+
+    if noisy:
+        print(f"\nWarning: noise exceeds {threshold:.0%} for {', '.join(noisy)}; "
+              f"results for these benchmarks are unreliable on this machine", file=sys.stderr)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for core hot paths")
+    parser.add_argument("--save", action="store_true", help="save results as the baseline")
+    parser.add_argument("--compare", action="store_true", help="compare results against the baseline")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline file path")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="allowed slowdown before failing, as a fraction (default 0.2 = 20%%)")
+    parser.add_argument("--only", nargs="+", metavar="NAME", help="run only the named benchmarks")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        baseline = load_baseline(args.baseline)
+        if baseline is None:
+            return 1
+
+    results = run_benchmarks(args.only)
+
+    if args.save:
+        save_baseline(results, args.baseline)
+
+    if args.compare:
+        confirm_regressions(results, baseline, args.threshold)
+        regressions = compare_baseline(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} benchmark(s) regressed by more than {args.threshold:.0%}: "
+                  f"{', '.join(regressions)}")
+            return 1
+        print(f"\nNo regressions above {args.threshold:.0%}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,12 +1,36 @@
+import asyncio
 import json
 import logging
 import websockets
 import connection_manager
 import room_manager
 import message_handler
+import rate_limiter
 
 logger = logging.getLogger("websocket_server")
 
+# 正在后台关闭的被接管连接（保留引用，避免任务被垃圾回收）
+closing_tasks = set()
+
+
+def close_task_done(task):
+    """后台关闭任务完成后移除引用并记录异常"""
+    closing_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        logger.error(f"Error closing taken over connection: {task.exception()}")
+
+
+def evict_session(session, device_id):
+    """将被接管的旧会话移出房间并关闭其连接"""
+    room_manager.remove_client_from_room(session["room_id"], session["client_id"])
+    connection_manager.remove_client(session["client_id"])
+    # 关闭握手在后台完成，不阻塞新连接
+    task = asyncio.create_task(session["websocket"].close(code=4000, reason="Session taken over"))
+    closing_tasks.add(task)
+    task.add_done_callback(close_task_done)
+    logger.info(f"Evicted previous session of device {device_id} (client {session['client_id']})")
+
+
 async def handle_client(websocket):
     """处理客户端连接"""
     # 为此连接生成唯一的客户端ID
@@ -14,11 +38,14 @@ async def handle_client(websocket):
     client_ip = websocket.remote_address[0] if hasattr(websocket, 'remote_address') else 'unknown'
     connection_manager.add_client(client_id, websocket)
 
+    # 记录连接建立顺序，同一设备只允许更晚建立的连接接管会话
+    connect_sequence = connection_manager.next_connect_sequence()
+
     # 这些将在客户端识别后设置
     device_id = None
     room_id = None
     identity = None
-    connection_id = None
+    session = None
 
     logger.info(f"New connection established - Connection ID: {client_id}, IP: {client_ip}")
 
@@ -67,8 +94,42 @@ async def handle_client(websocket):
                 logger.warning(f"Device {device_id} tried to join non-existent room {specified_room_id}")
                 return
 
-            # 记录此连接
-            connection_id = await connection_manager.log_connection(device_id, room_id, identity, client_ip)
+            if room_status == "room_unavailable":
+                if specified_room_id:
+                    message = f"Room {specified_room_id} is temporarily unavailable"
+                else:
+                    message = "Room assignment is temporarily unavailable"
+                await websocket.send(json.dumps({"type": "error", "message": message}))
+                logger.warning(f"Device {device_id} could not be assigned a room in degraded mode")
+                return
+
+            # 接管同一设备的旧会话（如果存在）
+            session, previous = connection_manager.claim_device_session(
+                device_id, client_id, websocket, room_id, connect_sequence
+            )
+            if not session:
+                error_msg = {"type": "error", "message": "Device is connected from a newer session"}
+                await websocket.send(json.dumps(error_msg))
+                return
+
+            replaced_session_key = None
+            if previous:
+                evict_session(previous, device_id)
+                # 旧会话的连接记录已发出时在同一批次中记录其断开，否则由旧会话自行记录
+                if previous["connection_logged"]:
+                    replaced_session_key = previous["session_key"]
+                    previous["disconnect_logged"] = True
+
+            # 记录此连接（被接管连接的断开在同一批次中记录，数据库不可用时一起进入spool）
+            await connection_manager.log_connection(
+                device_id, room_id, identity, client_ip, session["session_key"], replaced_session_key
+            )
+            session["connection_logged"] = True
+
+            # 等待数据库期间可能已被更新的连接接管
+            if connection_manager.device_sessions.get(device_id) is not session:
+                logger.info(f"Connection {client_id} was taken over before joining room {room_id}")
+                return
 
             # 将客户端添加到内存中的房间
             room_manager.add_client_to_room(room_id, client_id, websocket, identity, device_id)
@@ -86,6 +147,20 @@ async def handle_client(websocket):
             # 处理消息
             # 在 handle_client 函数中的消息处理循环部分
             async for message in websocket:
+                # 按设备、身份类别和房间限流
+                message_size = len(message.encode("utf-8")) if isinstance(message, str) else len(message)
+                admitted, action = await rate_limiter.admit(device_id, identity, room_id, message_size)
+                if not admitted:
+                    if action in ("error", "disconnect"):
+                        await websocket.send(json.dumps({
+                            "type": "error",
+                            "message": "Rate limit exceeded"
+                        }))
+                    if action == "disconnect":
+                        await websocket.close(code=1008, reason="Rate limit exceeded")
+                        break
+                    continue
+
                 logger.info(
                     f"Received message from client {client_id} (device {device_id}) in room {room_id}: {message}")
 
@@ -95,6 +170,9 @@ async def handle_client(websocket):
                     # 检查这是否是房间查询命令
                     if data.get("type") == "query_room":
                         await message_handler.handle_room_query(websocket, client_id, device_id, room_id)
+                    # 检查这是否是历史消息查询命令
+                    elif data.get("type") == "fetch_history":
+                        await message_handler.handle_history_fetch(websocket, client_id, device_id, room_id, data)
                     else:
                         # 转发消息
                         success, msg = await message_handler.forward_message(data, room_id, client_id, device_id)
@@ -126,9 +204,13 @@ async def handle_client(websocket):
     except Exception as e:
         logger.error(f"Unexpected error with client {client_id}: {str(e)}")
     finally:
-        # 记录断开连接
-        if connection_id:
-            await connection_manager.log_disconnection(connection_id)
+        # 释放设备会话（已被接管时不影响新会话）
+        if session:
+            connection_manager.release_device_session(device_id, client_id)
+
+        # 记录断开连接（被接管时已由新连接记录）
+        if session and session["connection_logged"] and not session["disconnect_logged"]:
+            await connection_manager.log_disconnection(session["session_key"])
 
         # 清理连接
         connection_manager.remove_client(client_id)
@@ -10,6 +10,40 @@ DB_CONFIG = {
     'port': 3306
 }
 
+# 数据库容错配置
+DB_RESILIENCE_CONFIG = {
+    'call_timeout': 2.0,          # 单次数据库调用的延迟预算（秒）
+    'slow_call_threshold': 1.0,   # 超过该耗时的调用计为失败（秒）
+    'failure_threshold': 5,       # 连续失败多少次后打开熔断器
+    'reset_timeout': 30,          # 熔断器打开后多久尝试探测恢复（秒）
+    'spool_path': 'db_spool.jsonl',  # 降级模式下写入的本地追加文件
+    'replay_interval': 10         # 重放spool文件的检查间隔（秒）
+}
+
+# 消息限流配置（令牌桶，rate 为每秒速率，burst 为允许突发的秒数，rate 为 None 表示不限制）
+RATE_LIMIT_CONFIG = {
+    'action': 'error',            # 超限处理方式：drop（静默丢弃）/ delay（延迟处理）/ error（回复错误）
+    'max_delay': 1.0,             # delay 模式下单条消息最多等待的秒数，超过则按 error 处理
+    'disconnect_after': 50,       # 连续超限多少条消息后断开连接（0 表示不断开）
+    'idle_ttl': 600,              # 设备/房间限流状态空闲多少秒后清理（断开连接后仍保留，防止重连绕过限流）
+    'device': {'messages_per_sec': 20, 'bytes_per_sec': 64 * 1024, 'burst': 2},
+    'identity': {
+        # 按身份类别覆盖单设备限额，例如：
+        # 'sensor_node': {'messages_per_sec': 5, 'bytes_per_sec': 8 * 1024, 'burst': 2},
+    },
+    'room': {'messages_per_sec': 200, 'bytes_per_sec': 1024 * 1024, 'burst': 2}
+}
+
+# 消息历史配置
+HISTORY_CONFIG = {
+    'page_size': 50,              # 默认每页消息数
+    'max_page_size': 200,         # 客户端可请求的最大每页消息数
+    'cache_size': 200,            # 每个房间在内存中缓存的最近消息数
+    'max_cached_rooms': 1000,     # 最多缓存多少个房间（LRU淘汰）
+    'max_concurrent_queries': 2,  # 历史查询专用连接池与线程池的大小，与实时消息写入隔离
+    'query_timeout': 5.0          # 单次历史查询的延迟预算（秒），不计入数据库熔断器
+}
+
 # 服务器配置
 SERVER_CONFIG = {
     'host': '0.0.0.0',
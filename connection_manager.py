@@ -1,4 +1,6 @@
+import itertools
 import logging
+import uuid
 from mysql.connector import Error
 import db_manager
 
@@ -7,66 +9,68 @@ logger = logging.getLogger("websocket_server")
 # 存储所有连接的客户端
 clients = {}
 
+# 设备ID -> 当前会话，每个设备同一时间只保留一个活跃会话
+device_sessions = {}
+
+# 会话接管次数（新连接顶替同一设备的旧连接）
+takeover_count = 0
+
+# 连接建立顺序号，用于判断同一设备的哪个连接更新
+connect_sequence = itertools.count(1)
+
+
+async def log_connection(device_id, room_id, identity, client_ip, session_key, replaced_session_key=None):
+    """
+    将新连接记录到数据库并返回连接ID。
+    session_key 为服务器生成的会话标识，断开连接时据此更新记录（spool重放后同样有效）。
+    如果提供了replaced_session_key，则在同一事务中记录被接管连接的断开。
+    数据库不可用时写入进入spool，返回None。
+    """
+    statements = [(
+        "INSERT INTO connections (device_id, room_id, identity, client_ip, session_key, connected_at) "
+        "VALUES (%s, %s, %s, %s, %s, %s)",
+        (device_id, room_id, identity, client_ip, session_key, db_manager.EVENT_TIME)
+    )]
+    if replaced_session_key:
+        statements.append((
+            "UPDATE connections SET disconnected_at = %s WHERE session_key = %s",
+            (db_manager.EVENT_TIME, replaced_session_key)
+        ))
 
-async def log_connection(device_id, room_id, identity, client_ip):
-    """将新连接记录到数据库并返回连接ID"""
     try:
-        conn = db_manager.get_connection()
-        if not conn:
-            logger.error("Failed to get database connection for logging connection")
+        row_ids = await db_manager.write(statements)
+        if row_ids is None:
+            logger.warning(f"Deferred connection record for session {session_key} of device {device_id}")
             return None
 
-        cursor = conn.cursor()
-
-        cursor.execute(
-            "INSERT INTO connections (device_id, room_id, identity, client_ip) VALUES (%s, %s, %s, %s)",
-            (device_id, room_id, identity, client_ip)
-        )
-
-        connection_id = cursor.lastrowid
-        conn.commit()
-
+        connection_id = row_ids[0]
         logger.info(f"Logged connection {connection_id} for device {device_id} in room {room_id}")
+        if replaced_session_key:
+            logger.info(f"Logged disconnection for replaced session {replaced_session_key}")
         return connection_id
 
     except Error as e:
         logger.error(f"Database error in log_connection: {e}")
         return None
-    finally:
-        if 'cursor' in locals():
-            cursor.close()
-        if 'conn' in locals():
-            conn.close()
 
 
-async def log_disconnection(connection_id):
+async def log_disconnection(session_key):
     """将断开连接记录到数据库"""
-    if not connection_id:
+    if not session_key:
         return
 
     try:
-        conn = db_manager.get_connection()
-        if not conn:
-            logger.error("Failed to get database connection for logging disconnection")
-            return
-
-        cursor = conn.cursor()
-
-        cursor.execute(
-            "UPDATE connections SET disconnected_at = NOW() WHERE id = %s",
-            (connection_id,)
-        )
-
-        conn.commit()
-        logger.info(f"Logged disconnection for connection {connection_id}")
+        row_ids = await db_manager.write([(
+            "UPDATE connections SET disconnected_at = %s WHERE session_key = %s",
+            (db_manager.EVENT_TIME, session_key)
+        )])
+        if row_ids is None:
+            logger.warning(f"Deferred disconnection record for session {session_key}")
+        else:
+            logger.info(f"Logged disconnection for session {session_key}")
 
     except Error as e:
         logger.error(f"Database error in log_disconnection: {e}")
-    finally:
-        if 'cursor' in locals():
-            cursor.close()
-        if 'conn' in locals():
-            conn.close()
 
 
 def add_client(client_id, websocket):
@@ -87,3 +91,54 @@ def remove_client(client_id):
 def get_client_count():
     """获取当前连接的客户端数量"""
     return len(clients)
+
+
+def next_connect_sequence():
+    """获取新连接的建立顺序号（在连接建立时调用）"""
+    return next(connect_sequence)
+
+
+def claim_device_session(device_id, client_id, websocket, room_id, sequence):
+    """
+    按连接建立顺序将设备的当前会话切换到此连接。
+    返回 (session, previous)，previous 为被接管的旧会话，没有则为 None；
+    设备已被更晚建立的连接占用时返回 (None, None)。
+    """
+    global takeover_count
+
+    previous = device_sessions.get(device_id)
+    if previous and previous["sequence"] > sequence:
+        logger.info(f"Device {device_id} already owned by newer client {previous['client_id']}, "
+                    f"not taking over from client {client_id}")
+        return None, None
+
+    session = {
+        "client_id": client_id,
+        "websocket": websocket,
+        "room_id": room_id,
+        "sequence": sequence,
+        "session_key": str(uuid.uuid4()),
+        "connection_logged": False,
+        "disconnect_logged": False
+    }
+    device_sessions[device_id] = session
+
+    if previous and previous["client_id"] != client_id:
+        takeover_count += 1
+        logger.info(f"Device {device_id} session taken over: client {previous['client_id']} -> {client_id}")
+        return session, previous
+    return session, None
+
+
+def release_device_session(device_id, client_id):
+    """释放设备会话（仅当会话仍属于此连接时）"""
+    session = device_sessions.get(device_id)
+    if session and session["client_id"] == client_id:
+        del device_sessions[device_id]
+        return True
+    return False
+
+
+def get_takeover_count():
+    """获取会话接管次数"""
+    return takeover_count
@@ -1,22 +1,83 @@
+import asyncio
+import datetime
+import json
 import logging
+import os
 import sys
-from mysql.connector import pooling, Error
-from config import DB_CONFIG
+import time
+from concurrent.futures import ThreadPoolExecutor
+from mysql.connector import pooling, Error, InterfaceError, OperationalError, PoolError
+from config import DB_CONFIG, DB_RESILIENCE_CONFIG, HISTORY_CONFIG
 
 logger = logging.getLogger("websocket_server")
 
+# 连接池大小
+POOL_SIZE = 5
+
 # 数据库连接池
 connection_pool = None
 
+# 数据库调用在独立线程池中执行，避免阻塞事件循环（线程数与连接池大小一致）
+executor = ThreadPoolExecutor(max_workers=POOL_SIZE, thread_name_prefix="db")
+
+# 历史查询使用独立的连接池和线程池，不与实时消息写入争用连接
+history_pool = None
+history_executor = ThreadPoolExecutor(max_workers=HISTORY_CONFIG['max_concurrent_queries'], thread_name_prefix="db-history")
+
+# 熔断器状态：closed（正常）、open（熔断）、half_open（探测中）
+breaker = {
+    "state": "closed",
+    "failures": 0,
+    "opened_at": 0.0,
+    "probing": False,
+    "trips": 0
+}
+
+# 是否正在重放spool文件
+replaying = False
+
+# 超时后仍在执行的写入，完成前新写入进入spool以保持顺序
+inflight_writes = set()
+
+# spool文件读写在单个线程中按提交顺序执行，不阻塞事件循环
+spool_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-spool")
+
+# 已提交但尚未写入文件的spool追加
+queued_spool_writes = set()
+
+# 写语句参数中的事件时间占位符，在 write()/spool() 时替换为当时的时间，
+# 使spool重放的写入保留事件发生的时间，而不是重放时的 NOW()
+EVENT_TIME = object()
+
+# 表示数据库不可用的驱动异常
+UNAVAILABLE_ERRORS = (InterfaceError, OperationalError, PoolError)
+
+
+class DatabaseUnavailable(Exception):
+    """数据库不可用（熔断器打开、调用超时或连接失败）"""
+
+
+class DatabaseTimeout(DatabaseUnavailable):
+    """数据库调用超时，但操作已在线程池中开始执行，future 为其执行结果"""
+
+    def __init__(self, message, future):
+        super().__init__(message)
+        self.future = future
+
 
 def init_database():
     """初始化数据库连接池和必要的表结构"""
-    global connection_pool
+    global connection_pool, history_pool
 
     try:
         connection_pool = pooling.MySQLConnectionPool(
             pool_name="websocket_pool",
-            pool_size=5,
+            pool_size=POOL_SIZE,
+            **DB_CONFIG
+        )
+        history_pool = pooling.MySQLConnectionPool(
+            pool_name="websocket_history_pool",
+            pool_size=HISTORY_CONFIG['max_concurrent_queries'],
             **DB_CONFIG
         )
         logger.info("Database connection pool created successfully")
@@ -52,11 +113,21 @@ def init_database():
             connected_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             disconnected_at TIMESTAMP NULL,
             client_ip VARCHAR(45),
+            session_key CHAR(36),
+            INDEX idx_connections_session_key (session_key),
             FOREIGN KEY (device_id) REFERENCES devices(device_id),
             FOREIGN KEY (room_id) REFERENCES rooms(room_id)
         )
         ''')
 
+        # 旧版本创建的connections表没有session_key列
+        cursor.execute("SHOW COLUMNS FROM connections LIKE 'session_key'")
+        if not cursor.fetchall():
+            cursor.execute(
+                "ALTER TABLE connections ADD COLUMN session_key CHAR(36), "
+                "ADD INDEX idx_connections_session_key (session_key)"
+            )
+
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS messages (
             id INT AUTO_INCREMENT PRIMARY KEY,
@@ -66,6 +137,7 @@ def init_database():
             message_content TEXT,
             message_type ENUM('broadcast', 'direct') DEFAULT 'broadcast',
             sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            INDEX idx_messages_room_id (room_id, id),
             FOREIGN KEY (room_id) REFERENCES rooms(room_id)
         )
         ''')
@@ -99,3 +171,365 @@ def get_connection():
     else:
         logger.error("Database connection pool not initialized")
         return None
+
+
+def get_history_connection():
+    """获取历史查询专用的数据库连接"""
+    if history_pool:
+        return history_pool.get_connection()
+    else:
+        logger.error("History connection pool not initialized")
+        return None
+
+
+def breaker_allows():
+    """判断熔断器是否允许发起数据库调用"""
+    if breaker["state"] == "closed":
+        return True
+
+    if breaker["state"] == "open":
+        if time.monotonic() - breaker["opened_at"] < DB_RESILIENCE_CONFIG['reset_timeout']:
+            return False
+        breaker["state"] = "half_open"
+        logger.info("Database circuit breaker half-open, probing database")
+
+    # 半开状态下同一时间只允许一个探测调用
+    if breaker["probing"]:
+        return False
+    breaker["probing"] = True
+    return True
+
+
+def record_success():
+    """记录一次成功的数据库调用"""
+    if breaker["state"] != "closed":
+        logger.info("Database circuit breaker closed, database recovered")
+    breaker["state"] = "closed"
+    breaker["failures"] = 0
+    breaker["probing"] = False
+
+
+def record_failure(reason):
+    """记录一次失败（或过慢）的数据库调用，达到阈值时打开熔断器"""
+    breaker["failures"] += 1
+    breaker["probing"] = False
+    logger.warning(f"Database call failed ({breaker['failures']} consecutive): {reason}")
+
+    if breaker["state"] == "half_open" or (
+            breaker["state"] == "closed" and breaker["failures"] >= DB_RESILIENCE_CONFIG['failure_threshold']):
+        breaker["state"] = "open"
+        breaker["opened_at"] = time.monotonic()
+        breaker["trips"] += 1
+        logger.error(f"Database circuit breaker opened after {breaker['failures']} failures")
+
+
+def get_breaker_state():
+    """获取熔断器当前状态"""
+    return breaker["state"]
+
+
+async def run(operation, *args):
+    """
+    在数据库线程池中执行同步数据库操作，受延迟预算和熔断器保护。
+    数据库不可用时抛出 DatabaseUnavailable，其他数据库错误原样抛出。
+    如果操作在超时前已开始执行，抛出 DatabaseTimeout，调用方可通过其 future 获取最终结果。
+    """
+    if not breaker_allows():
+        raise DatabaseUnavailable("circuit breaker is open")
+
+    # 半开状态下放行的调用即为探测调用，无论以何种方式结束都要释放探测名额
+    probe = breaker["state"] == "half_open"
+    timeout = DB_RESILIENCE_CONFIG['call_timeout']
+    start = time.monotonic()
+    future = executor.submit(operation, *args)
+    try:
+        result = await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+    except asyncio.TimeoutError:
+        record_failure(f"timed out after {timeout}s")
+        # wait_for只停止等待，已开始执行的操作仍会继续
+        if future.cancel() or future.cancelled():
+            raise DatabaseUnavailable(f"database call timed out after {timeout}s in queue")
+        raise DatabaseTimeout(f"database call timed out after {timeout}s", future)
+    except (DatabaseUnavailable,) + UNAVAILABLE_ERRORS as e:
+        record_failure(str(e))
+        raise DatabaseUnavailable(str(e)) from e
+    except Error:
+        # 数据库有响应，只是语句本身出错
+        record_success()
+        raise
+    finally:
+        if probe:
+            breaker["probing"] = False
+
+    elapsed = time.monotonic() - start
+    if elapsed > DB_RESILIENCE_CONFIG['slow_call_threshold']:
+        record_failure(f"slow call took {elapsed:.2f}s")
+    else:
+        record_success()
+    return result
+
+
+async def run_history(operation, *args):
+    """
+    在历史查询专用线程池中执行只读查询，受 HISTORY_CONFIG 的延迟预算限制。
+    结果不计入熔断器（慢查询不会让实时路由进入降级模式），熔断器打开时直接失败。
+    """
+    if breaker["state"] == "open":
+        raise DatabaseUnavailable("circuit breaker is open")
+
+    timeout = HISTORY_CONFIG['query_timeout']
+    future = history_executor.submit(operation, *args)
+    try:
+        return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+    except asyncio.TimeoutError:
+        future.cancel()
+        raise DatabaseUnavailable(f"history query timed out after {timeout}s")
+    except (DatabaseUnavailable,) + UNAVAILABLE_ERRORS as e:
+        raise DatabaseUnavailable(str(e)) from e
+
+
+def execute_statements(statements):
+    """在同一事务中执行一组写语句，返回每条语句的lastrowid"""
+    conn = get_connection()
+    if not conn:
+        raise DatabaseUnavailable("Database connection pool not initialized")
+
+    cursor = conn.cursor()
+    try:
+        row_ids = []
+        for sql, params in statements:
+            cursor.execute(sql, params)
+            row_ids.append(cursor.lastrowid)
+        conn.commit()
+        return row_ids
+    except Error:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def replay_path():
+    """正在重放的spool文件路径"""
+    return DB_RESILIENCE_CONFIG['spool_path'] + ".replaying"
+
+
+def late_path():
+    """超时后最终失败的写入的追加文件路径（重放时排在普通spool之前）"""
+    return DB_RESILIENCE_CONFIG['spool_path'] + ".late"
+
+
+def spool_pending():
+    """是否存在尚未重放的写入（存在时新写入也必须进入spool以保持顺序）"""
+    return (replaying or bool(inflight_writes) or bool(queued_spool_writes)
+            or any(os.path.exists(path) for path in (DB_RESILIENCE_CONFIG['spool_path'], late_path(), replay_path())))
+
+
+def append_entry(path, statements):
+    """向spool文件追加一行（在spool线程中执行）"""
+    # 上次追加中途崩溃留下的残行没有换行符，新行另起一行，避免与残行粘连
+    torn = False
+    if os.path.exists(path) and os.path.getsize(path):
+        with open(path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            torn = f.read(1) != b"\n"
+
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(("\n" if torn else "") + json.dumps(statements) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def spool_write_done(future):
+    """spool写入完成后移除跟踪，失败时记录错误"""
+    queued_spool_writes.discard(future)
+    if not future.cancelled() and future.exception():
+        logger.error(f"Failed to write spool file: {future.exception()}")
+
+
+def event_time():
+    """当前时间，格式与 TIMESTAMP 列一致"""
+    return datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+def bind_event_time(statements):
+    """将写语句参数中的 EVENT_TIME 替换为当前时间"""
+    now = event_time()
+    return [
+        (sql, tuple(now if param is EVENT_TIME else param for param in params))
+        for sql, params in statements
+    ]
+
+
+def spool(statements, late=False):
+    """
+    将一组写语句追加到本地spool文件，等待数据库恢复后重放。
+    文件写入在spool线程中按提交顺序执行，不阻塞事件循环。
+    late 为 True 时写入单独的追加文件（用于比已spool写入更早发出的超时写入）。
+    """
+    path = late_path() if late else DB_RESILIENCE_CONFIG['spool_path']
+    future = spool_executor.submit(append_entry, path, bind_event_time(statements))
+    queued_spool_writes.add(future)
+    future.add_done_callback(spool_write_done)
+
+
+def late_write_done(statements, future):
+    """超时写入最终完成后的处理：失败时进入spool，成功时不再重复写入"""
+    inflight_writes.discard(future)
+
+    if future.cancelled():
+        spool(statements, late=True)
+        return
+
+    error = future.exception()
+    if error is None:
+        logger.info("Timed out database write completed late, not spooling it")
+    elif isinstance(error, (DatabaseUnavailable,) + UNAVAILABLE_ERRORS):
+        logger.warning(f"Timed out database write failed, spooling it: {error}")
+        spool(statements, late=True)
+    else:
+        logger.error(f"Timed out database write failed: {error}")
+
+
+def track_late_write(statements, future):
+    """跟踪超时后仍在执行的写入，直到其完成"""
+    loop = asyncio.get_running_loop()
+    inflight_writes.add(future)
+    future.add_done_callback(lambda f: loop.call_soon_threadsafe(late_write_done, statements, f))
+
+
+async def write(statements):
+    """
+    在同一事务中执行写语句，返回每条语句的lastrowid列表。
+    数据库不可用或仍有待重放的写入时，追加到spool文件并返回None。
+    写入超时但已发出时不进入spool（避免重复写入），由 track_late_write 跟踪其结果并返回None。
+    参数中的 EVENT_TIME 在此时绑定，直接写入和spool重放使用同一时间。
+    """
+    statements = bind_event_time(statements)
+    if not spool_pending():
+        try:
+            return await run(execute_statements, statements)
+        except DatabaseTimeout as e:
+            logger.warning(f"Database write timed out, waiting for it in the background: {e}")
+            track_late_write(statements, e.future)
+            return None
+        except DatabaseUnavailable as e:
+            logger.warning(f"Database unavailable, spooling write: {e}")
+
+    spool(statements)
+    return None
+
+
+def is_valid_entry(statements):
+    """检查spool中的一行是否为 [[sql, params], ...] 格式"""
+    return isinstance(statements, list) and all(
+        isinstance(statement, list) and len(statement) == 2
+        and isinstance(statement[0], str) and isinstance(statement[1], list)
+        for statement in statements
+    )
+
+
+def load_replay_batch():
+    """
+    取出下一批待重放的写入（在spool线程中执行），没有时返回None。
+    顺序为：上次中断的重放文件、超时后失败的写入、普通spool。无法解析的行记录后跳过。
+    """
+    path = replay_path()
+    if not os.path.exists(path):
+        for source in (late_path(), DB_RESILIENCE_CONFIG['spool_path']):
+            if os.path.exists(source):
+                os.replace(source, path)
+                break
+        else:
+            return None
+
+    entries = []
+    with open(path, encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                statements = json.loads(line)
+            except ValueError as e:
+                logger.error(f"Skipping malformed spool line {number}: {e}")
+                continue
+            if not is_valid_entry(statements):
+                logger.error(f"Skipping invalid spool line {number}")
+                continue
+            entries.append(statements)
+    return entries
+
+
+def save_replay_remaining(entries):
+    """原子地保存尚未重放的写入（在spool线程中执行）"""
+    temp_path = replay_path() + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        for statements in entries:
+            f.write(json.dumps(statements) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, replay_path())
+
+
+def finish_replay_batch():
+    """删除已重放完成的文件（在spool线程中执行）"""
+    os.remove(replay_path())
+
+
+def breaker_open():
+    """熔断器是否打开且尚未到探测时间"""
+    return (breaker["state"] == "open"
+            and time.monotonic() - breaker["opened_at"] < DB_RESILIENCE_CONFIG['reset_timeout'])
+
+
+async def replay_spool():
+    """按顺序重放spool文件中的写入，返回本次重放的条数"""
+    global replaying
+
+    # 超时写入尚未完成时不重放，避免与其顺序错乱；熔断期间不重放，避免反复改写文件
+    if replaying or inflight_writes or breaker_open():
+        return 0
+
+    loop = asyncio.get_running_loop()
+    replaying = True
+    try:
+        replayed = 0
+        while True:
+            # 文件操作与spool追加在同一线程中执行，二者不会交错
+            entries = await loop.run_in_executor(spool_executor, load_replay_batch)
+            if entries is None:
+                break
+
+            done = 0
+            try:
+                for statements in entries:
+                    try:
+                        await run(execute_statements, statements)
+                    except DatabaseTimeout as e:
+                        # 已发出的写入仍在执行，等待其结果再决定是否重试，避免重复写入
+                        try:
+                            await asyncio.wrap_future(e.future)
+                        except (DatabaseUnavailable,) + UNAVAILABLE_ERRORS:
+                            raise DatabaseUnavailable(str(e))
+                        except Error as err:
+                            logger.error(f"Dropping spooled write that failed to replay: {err}")
+                    except DatabaseUnavailable:
+                        raise
+                    except Error as e:
+                        logger.error(f"Dropping spooled write that failed to replay: {e}")
+                    done += 1
+            except DatabaseUnavailable as e:
+                # 保留尚未重放的部分，等待下次重试
+                await loop.run_in_executor(spool_executor, save_replay_remaining, entries[done:])
+                logger.warning(f"Spool replay paused after {replayed + done} writes: {e}")
+                return replayed + done
+
+            await loop.run_in_executor(spool_executor, finish_replay_batch)
+            replayed += done
+
+        if replayed:
+            logger.info(f"Replayed {replayed} spooled writes")
+        return replayed
+    finally:
+        replaying = False
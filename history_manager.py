@@ -0,0 +1,217 @@
+import bisect
+import json
+import logging
+from collections import OrderedDict
+import db_manager
+from config import HISTORY_CONFIG
+
+logger = logging.getLogger("websocket_server")
+
+# 房间ID -> 最近消息缓存 {"ids": [...], "rows": [...], "complete": bool}，按消息ID升序，LRU淘汰
+# complete 为 True 表示缓存包含该房间的全部历史
+history_cache = OrderedDict()
+
+# 房间ID -> 正在进行的缓存加载列表 [{"dirty": bool}]，加载期间有新写入时标记 dirty 并丢弃加载结果
+# 只在加载期间存在，加载结束后移除
+pending_loads = {}
+
+HISTORY_COLUMNS = "id, from_device_id, to_device_id, message_content, message_type, sent_at"
+
+
+def format_row(row):
+    """将数据库行转换为缓存行"""
+    sent_at = row["sent_at"]
+    return {
+        "id": row["id"],
+        "from_device_id": row["from_device_id"],
+        "to_device_id": row["to_device_id"],
+        "message_content": row["message_content"],
+        "message_type": row["message_type"],
+        "sent_at": sent_at.strftime('%Y-%m-%d %H:%M:%S') if sent_at else None
+    }
+
+
+def select_recent(room_id, count):
+    """查询房间最近的消息（在数据库线程池中执行）"""
+    return select_page(room_id, None, None, count)
+
+
+def select_page(room_id, device_id, before_id, count):
+    """
+    按 (room_id, id) 键集分页查询消息，按ID从新到旧返回（在数据库线程池中执行）。
+    device_id 不为空时只返回该设备可见的消息（广播或与其相关的定向消息）。
+    """
+    conn = db_manager.get_history_connection()
+    if not conn:
+        raise db_manager.DatabaseUnavailable("History connection pool not initialized")
+
+    cursor = conn.cursor(dictionary=True)
+    try:
+        sql = f"SELECT {HISTORY_COLUMNS} FROM messages WHERE room_id = %s"
+        params = [room_id]
+        if before_id is not None:
+            sql += " AND id < %s"
+            params.append(before_id)
+        if device_id is not None:
+            sql += " AND (message_type = 'broadcast' OR from_device_id = %s OR to_device_id = %s)"
+            params.extend([device_id, device_id])
+        sql += " ORDER BY id DESC LIMIT %s"
+        params.append(count)
+
+        cursor.execute(sql, params)
+        return [format_row(row) for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def is_visible(row, device_id):
+    """判断消息对设备是否可见"""
+    return row["message_type"] == "broadcast" or device_id in (row["from_device_id"], row["to_device_id"])
+
+
+def mark_loads_dirty(room_id=None):
+    """将房间（room_id 为空时为所有房间）正在进行的缓存加载标记为过期"""
+    loads = pending_loads.values() if room_id is None else [pending_loads.get(room_id, [])]
+    for room_loads in loads:
+        for load in room_loads:
+            load["dirty"] = True
+
+
+def clear_cache():
+    """清空所有房间的缓存（spool重放写入了缓存之外的消息时调用）"""
+    history_cache.clear()
+    mark_loads_dirty()
+
+
+def record_message(message_id, from_device_id, to_device_id, room_id, message_content, message_type, sent_at):
+    """
+    将新写入的消息追加到房间缓存，message_id 为空（写入进入spool）时使缓存失效。
+    sent_at 为写入数据库的同一时间，缓存与数据库中的消息时间一致。
+    """
+    mark_loads_dirty(room_id)
+
+    cache = history_cache.get(room_id)
+    if cache is None:
+        return
+
+    if message_id is None:
+        # 无法获得消息ID，缓存不再是连续的最新消息
+        del history_cache[room_id]
+        return
+
+    ids = cache["ids"]
+    index = bisect.bisect_left(ids, message_id)
+    if index < len(ids) and ids[index] == message_id:
+        return
+
+    ids.insert(index, message_id)
+    cache["rows"].insert(index, {
+        "id": message_id,
+        "from_device_id": from_device_id,
+        "to_device_id": to_device_id,
+        "message_content": message_content,
+        "message_type": message_type,
+        "sent_at": sent_at
+    })
+
+    if len(ids) > HISTORY_CONFIG['cache_size']:
+        del ids[0]
+        del cache["rows"][0]
+        cache["complete"] = False
+
+
+async def get_cache(room_id):
+    """获取房间缓存，不存在时从数据库加载；数据库不可用时返回None"""
+    cache = history_cache.get(room_id)
+    if cache is not None:
+        history_cache.move_to_end(room_id)
+        return cache
+
+    load = {"dirty": False}
+    pending_loads.setdefault(room_id, []).append(load)
+    try:
+        rows = await db_manager.run_history(select_recent, room_id, HISTORY_CONFIG['cache_size'])
+    except db_manager.DatabaseUnavailable as e:
+        logger.warning(f"Database unavailable while loading history cache for room {room_id}: {e}")
+        return None
+    finally:
+        room_loads = pending_loads[room_id]
+        room_loads.remove(load)
+        if not room_loads:
+            del pending_loads[room_id]
+
+    rows.reverse()
+    cache = {
+        "ids": [row["id"] for row in rows],
+        "rows": rows,
+        "complete": len(rows) < HISTORY_CONFIG['cache_size']
+    }
+
+    # 加载期间有新消息写入，或仍有未重放的写入时，加载结果可能缺少这些消息，只用于本次查询
+    if load["dirty"] or room_id in history_cache or db_manager.spool_pending():
+        return cache
+
+    history_cache[room_id] = cache
+    if len(history_cache) > HISTORY_CONFIG['max_cached_rooms']:
+        history_cache.popitem(last=False)
+    return cache
+
+
+def page_from_cache(cache, device_id, before_id, limit):
+    """
+    从缓存中取出一页可见消息，返回 (rows, has_more)。
+    缓存不足以确定完整的一页时返回None。
+    """
+    ids = cache["ids"]
+    end = bisect.bisect_left(ids, before_id) if before_id is not None else len(ids)
+
+    rows = []
+    for index in range(end - 1, -1, -1):
+        row = cache["rows"][index]
+        if is_visible(row, device_id):
+            rows.append(row)
+            if len(rows) > limit:
+                return rows[:limit], True
+
+    if cache["complete"]:
+        return rows, False
+    return None
+
+
+async def fetch_page(room_id, device_id, before_id=None, limit=None):
+    """
+    获取房间中设备可见的一页历史消息（按ID从新到旧），返回 (rows, has_more)。
+    优先使用内存缓存，缓存无法覆盖时使用键集分页查询数据库。
+    """
+    limit = limit or HISTORY_CONFIG['page_size']
+
+    cache = await get_cache(room_id)
+    if cache is not None:
+        page = page_from_cache(cache, device_id, before_id, limit)
+        if page is not None:
+            return page
+
+    rows = await db_manager.run_history(select_page, room_id, device_id, before_id, limit + 1)
+    return rows[:limit], len(rows) > limit
+
+
+def to_envelope(row):
+    """将消息行转换为发送给客户端的格式（与实时转发的消息格式一致）"""
+    try:
+        payload = json.loads(row["message_content"])
+    except (TypeError, ValueError):
+        payload = None
+    if not isinstance(payload, dict):
+        payload = {"content": row["message_content"]}
+
+    return {
+        "id": row["id"],
+        "type": payload.get("type", "message"),
+        "content": payload.get("content"),
+        "from_device_id": row["from_device_id"],
+        "to_device_id": row["to_device_id"],
+        "message_type": row["message_type"],
+        "timestamp": payload.get("timestamp", ""),
+        "sent_at": row["sent_at"]
+    }
@@ -3,11 +3,13 @@ import datetime
 import websockets
 import logging
 import sys
-from config import setup_logging, SERVER_CONFIG
+from config import setup_logging, SERVER_CONFIG, DB_RESILIENCE_CONFIG
 import db_manager
 import room_manager
 import connection_manager
 import client_handler
+import rate_limiter
+import history_manager
 
 # 配置日志
 logger = setup_logging()
@@ -19,7 +21,17 @@ async def status_reporter():
         await asyncio.sleep(60)  # 每分钟报告一次
         client_count = connection_manager.get_client_count()
         room_count = len(room_manager.rooms)
-        logger.info(f"Server status: {client_count} clients connected, {room_count} active rooms")
+        takeover_count = connection_manager.get_takeover_count()
+        breaker_state = db_manager.get_breaker_state()
+        logger.info(f"Server status: {client_count} clients connected, {room_count} active rooms, "
+                    f"{takeover_count} session takeovers, database circuit {breaker_state}")
+
+        rate_limiter.cleanup_idle()
+        throttle_stats = rate_limiter.get_throttle_stats()
+        if any(throttle_stats.values()):
+            logger.info(f"Rate limiting: {throttle_stats['dropped']} dropped, {throttle_stats['delayed']} delayed, "
+                        f"{throttle_stats['rejected']} rejected, {throttle_stats['disconnected']} disconnected, "
+                        f"{throttle_stats['throttled_bytes']} bytes throttled")
 
         for rid, room in room_manager.rooms.items():
             clients_in_room = [f"{cid}({client['device_id']}:{client['identity']})" for cid, client in room.items()]
@@ -27,6 +39,20 @@ async def status_reporter():
                 logger.info(f"Room {rid}: {', '.join(clients_in_room)}")
 
 
+async def spool_replayer():
+    """定期将降级模式下写入spool的数据重放到数据库"""
+    while True:
+        await asyncio.sleep(DB_RESILIENCE_CONFIG['replay_interval'])
+        if not db_manager.spool_pending():
+            continue
+        try:
+            # 重放写入的消息不在历史缓存中，清空缓存以免分页跳过这些消息
+            if await db_manager.replay_spool():
+                history_manager.clear_cache()
+        except Exception as e:
+            logger.error(f"Error replaying spooled writes: {e}")
+
+
 async def main():
     """主程序入口点"""
     host = SERVER_CONFIG['host']
@@ -48,6 +74,9 @@ async def main():
     # 启动状态报告器
     asyncio.create_task(status_reporter())
 
+    # 启动spool重放任务
+    asyncio.create_task(spool_replayer())
+
     # 等待服务器关闭
     await server.wait_closed()
 
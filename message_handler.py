@@ -2,61 +2,49 @@ import json
 import logging
 from mysql.connector import Error
 import db_manager
+import history_manager
 import room_manager
+from config import HISTORY_CONFIG
 
 logger = logging.getLogger("websocket_server")
 
 
 async def log_message(from_device_id, to_device_id, room_id, message_content, message_type="broadcast"):
-    """将消息记录到数据库"""
+    """将消息记录到数据库（数据库不可用时进入spool）"""
+    # 数据库和历史缓存使用同一发送时间
+    sent_at = db_manager.event_time()
     try:
-        conn = db_manager.get_connection()
-        if not conn:
-            logger.error("Failed to get database connection for logging message")
-            return
-
-        cursor = conn.cursor()
-
-        cursor.execute(
-            "INSERT INTO messages (from_device_id, to_device_id, room_id, message_content, message_type) VALUES (%s, %s, %s, %s, %s)",
-            (from_device_id, to_device_id, room_id, message_content, message_type)
+        row_ids = await db_manager.write([(
+            "INSERT INTO messages (from_device_id, to_device_id, room_id, message_content, message_type, sent_at) "
+            "VALUES (%s, %s, %s, %s, %s, %s)",
+            (from_device_id, to_device_id, room_id, message_content, message_type, sent_at)
+        )])
+
+        # 更新房间的最近消息缓存
+        history_manager.record_message(
+            row_ids[0] if row_ids else None,
+            from_device_id,
+            to_device_id,
+            room_id,
+            message_content,
+            message_type,
+            sent_at
         )
 
-        conn.commit()
-
     except Error as e:
         logger.error(f"Database error in log_message: {e}")
-    finally:
-        if 'cursor' in locals():
-            cursor.close()
-        if 'conn' in locals():
-            conn.close()
 
 
 async def log_room_query(device_id, room_id):
-    """将房间查询记录到数据库"""
+    """将房间查询记录到数据库（数据库不可用时进入spool）"""
     try:
-        conn = db_manager.get_connection()
-        if not conn:
-            logger.error("Failed to get database connection for logging room query")
-            return
-
-        cursor = conn.cursor()
-
-        cursor.execute(
-            "INSERT INTO room_queries (device_id, room_id) VALUES (%s, %s)",
-            (device_id, room_id)
-        )
-
-        conn.commit()
+        await db_manager.write([(
+            "INSERT INTO room_queries (device_id, room_id, queried_at) VALUES (%s, %s, %s)",
+            (device_id, room_id, db_manager.EVENT_TIME)
+        )])
 
     except Error as e:
         logger.error(f"Database error in log_room_query: {e}")
-    finally:
-        if 'cursor' in locals():
-            cursor.close()
-        if 'conn' in locals():
-            conn.close()
 
 
 async def validate_message(data):
@@ -165,3 +153,37 @@ async def handle_room_query(websocket, client_id, device_id, room_id):
     }
     await websocket.send(json.dumps(query_response))
     logger.info(f"Sent room query response to client {client_id} (device {device_id})")
+
+
+async def handle_history_fetch(websocket, client_id, device_id, room_id, data):
+    """处理历史消息分页请求"""
+    before_id = data.get("before_id")
+    limit = data.get("limit", HISTORY_CONFIG['page_size'])
+
+    if before_id is not None and (not isinstance(before_id, int) or isinstance(before_id, bool)):
+        await websocket.send(json.dumps({"type": "error", "message": "Invalid before_id"}))
+        return
+    if not isinstance(limit, int) or isinstance(limit, bool) or not 0 < limit <= HISTORY_CONFIG['max_page_size']:
+        await websocket.send(json.dumps({
+            "type": "error",
+            "message": f"Invalid limit (1-{HISTORY_CONFIG['max_page_size']})"
+        }))
+        return
+
+    try:
+        rows, has_more = await history_manager.fetch_page(room_id, device_id, before_id, limit)
+    except (db_manager.DatabaseUnavailable, Error) as e:
+        logger.error(f"Error fetching history for room {room_id}: {e}")
+        await websocket.send(json.dumps({"type": "error", "message": "History temporarily unavailable"}))
+        return
+
+    messages = [history_manager.to_envelope(row) for row in rows]
+    history_response = {
+        "type": "history",
+        "room_id": room_id,
+        "messages": messages,
+        "has_more": has_more,
+        "next_before_id": messages[-1]["id"] if has_more else None
+    }
+    await websocket.send(json.dumps(history_response))
+    logger.info(f"Sent {len(messages)} history messages to client {client_id} (device {device_id})")
@@ -0,0 +1,153 @@
+import asyncio
+import logging
+import math
+import time
+from config import RATE_LIMIT_CONFIG
+
+logger = logging.getLogger("websocket_server")
+
+# 设备ID -> {"identity", "buckets", "strikes", "last_seen"}，断开连接后保留，空闲超时后清理
+device_buckets = {}
+
+# 房间ID -> {"buckets", "last_seen"}（房间内所有设备共享）
+room_buckets = {}
+
+# 限流统计
+throttle_stats = {
+    "dropped": 0,
+    "delayed": 0,
+    "rejected": 0,
+    "disconnected": 0,
+    "throttled_bytes": 0
+}
+
+
+def create_buckets(limits):
+    """根据限额配置创建消息数和字节数两个令牌桶"""
+    now = time.monotonic()
+    buckets = {}
+    for kind, rate_key in (("messages", "messages_per_sec"), ("bytes", "bytes_per_sec")):
+        rate = limits.get(rate_key)
+        if rate:
+            capacity = rate * limits.get("burst", 1)
+            buckets[kind] = {"rate": rate, "capacity": capacity, "tokens": capacity, "updated": now}
+    return buckets
+
+
+def get_device_entry(device_id, identity):
+    """获取设备的限流状态，身份类别变化时按新限额重建令牌桶"""
+    entry = device_buckets.get(device_id)
+    if not entry or entry["identity"] != identity:
+        limits = RATE_LIMIT_CONFIG['identity'].get(identity, RATE_LIMIT_CONFIG['device'])
+        strikes = entry["strikes"] if entry else 0
+        entry = {"identity": identity, "buckets": create_buckets(limits), "strikes": strikes}
+        device_buckets[device_id] = entry
+    entry["last_seen"] = time.monotonic()
+    return entry
+
+
+def get_room_buckets(room_id):
+    """获取房间共享的令牌桶"""
+    entry = room_buckets.get(room_id)
+    if not entry:
+        entry = {"buckets": create_buckets(RATE_LIMIT_CONFIG['room'])}
+        room_buckets[room_id] = entry
+    entry["last_seen"] = time.monotonic()
+    return entry["buckets"]
+
+
+def bucket_wait(bucket, amount, now):
+    """补充令牌后返回获取 amount 个令牌需要等待的秒数（无法满足时为 inf）"""
+    bucket["tokens"] = min(bucket["capacity"], bucket["tokens"] + (now - bucket["updated"]) * bucket["rate"])
+    bucket["updated"] = now
+    if amount > bucket["capacity"]:
+        return math.inf
+    if amount > bucket["tokens"]:
+        return (amount - bucket["tokens"]) / bucket["rate"]
+    return 0.0
+
+
+def acquire(device_id, identity, room_id, size):
+    """
+    尝试为一条消息获取设备和房间令牌。
+    全部足够时扣除令牌并返回 (0, None)；否则不扣除，返回需要等待的秒数（无法满足时为 inf）
+    和造成限流的范围："device"（设备自身超限，优先）或 "room"（房间整体超限）。
+    """
+    now = time.monotonic()
+    scopes = (("device", get_device_entry(device_id, identity)["buckets"]), ("room", get_room_buckets(room_id)))
+
+    checks = []
+    wait = 0.0
+    scope = None
+    for name, buckets in scopes:
+        for kind, amount in (("messages", 1), ("bytes", size)):
+            if kind not in buckets:
+                continue
+            checks.append((buckets[kind], amount))
+            bucket_wait_time = bucket_wait(buckets[kind], amount, now)
+            if bucket_wait_time > wait:
+                wait = bucket_wait_time
+            if bucket_wait_time and scope is None:
+                scope = name
+
+    if wait == 0.0:
+        for bucket, amount in checks:
+            bucket["tokens"] -= amount
+    return wait, scope
+
+
+async def admit(device_id, identity, room_id, size):
+    """
+    按配置的限流策略处理一条入站消息。
+    返回 (admitted, action)，action 为 None、"drop"、"error" 或 "disconnect"。
+    """
+    wait, scope = acquire(device_id, identity, room_id, size)
+
+    if wait and RATE_LIMIT_CONFIG['action'] == "delay" and wait <= RATE_LIMIT_CONFIG['max_delay']:
+        # 延迟期间不读取该连接的后续消息，形成背压
+        throttle_stats["delayed"] += 1
+        await asyncio.sleep(wait)
+        wait, scope = acquire(device_id, identity, room_id, size)
+
+    entry = device_buckets[device_id]
+    if not wait:
+        entry["strikes"] = 0
+        return True, None
+
+    throttle_stats["throttled_bytes"] += size
+
+    # 只有设备自身超限才计入连续超限次数，房间被其他设备占满时不惩罚该设备
+    if scope == "device":
+        entry["strikes"] += 1
+
+        disconnect_after = RATE_LIMIT_CONFIG['disconnect_after']
+        if disconnect_after and entry["strikes"] >= disconnect_after:
+            throttle_stats["disconnected"] += 1
+            logger.warning(f"Device {device_id} exceeded rate limit {entry['strikes']} times in a row, disconnecting")
+            return False, "disconnect"
+
+        if entry["strikes"] == 1:
+            logger.warning(f"Device {device_id} in room {room_id} is being rate limited")
+
+    if RATE_LIMIT_CONFIG['action'] == "drop":
+        throttle_stats["dropped"] += 1
+        return False, "drop"
+
+    throttle_stats["rejected"] += 1
+    return False, "error"
+
+
+def cleanup_idle():
+    """清理空闲超过 idle_ttl 秒的设备和房间限流状态，返回清理的条数"""
+    cutoff = time.monotonic() - RATE_LIMIT_CONFIG['idle_ttl']
+    removed = 0
+    for table in (device_buckets, room_buckets):
+        for key in [key for key, entry in table.items() if entry["last_seen"] < cutoff]:
+            del table[key]
+            removed += 1
+    return removed
+
+
+def get_throttle_stats():
+    """获取限流统计"""
+    return dict(throttle_stats)
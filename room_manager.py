@@ -15,23 +15,30 @@ def generate_room_id():
     return ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
 
 
-async def get_or_create_room_for_device(device_id, identity, specified_room_id=None):
+# 设备ID -> 最近分配的房间ID，数据库不可用时用于降级路由
+device_rooms = {}
+
+# 设备记录的写入语句（降级模式下无法确认设备是否存在，使用upsert）
+# 参数：device_id, last_room_id, last_identity, 事件时间, 事件时间
+UPSERT_DEVICE_SQL = (
+    "INSERT INTO devices (device_id, last_room_id, last_identity, first_connected_at, last_connected_at) "
+    "VALUES (%s, %s, %s, %s, %s) "
+    "ON DUPLICATE KEY UPDATE last_connected_at = VALUES(last_connected_at), last_room_id = VALUES(last_room_id), "
+    "last_identity = VALUES(last_identity)"
+)
+
+
+def resolve_room(device_id, identity, specified_room_id=None):
     """
-    获取设备的现有房间或创建新房间（如果设备是首次连接）。
-    如果提供了specified_room_id，则加入该房间。
+    在数据库中解析设备的房间（在数据库线程池中执行，不修改内存状态）。
     返回 room_id, is_new_device, room_status
     """
-    try:
-        conn = db_manager.get_connection()
-        if not conn:
-            # 数据库连接失败，使用内存中的房间作为回退
-            new_room_id = generate_room_id()
-            if new_room_id not in rooms:
-                rooms[new_room_id] = {}
-            return new_room_id, True, "created_new_fallback"
-
-        cursor = conn.cursor(dictionary=True)
+    conn = db_manager.get_connection()
+    if not conn:
+        raise db_manager.DatabaseUnavailable("Database connection pool not initialized")
 
+    cursor = conn.cursor(dictionary=True)
+    try:
         # 检查指定的房间ID是否存在
         if specified_room_id:
             cursor.execute("SELECT room_id FROM rooms WHERE room_id = %s", (specified_room_id,))
@@ -61,10 +68,6 @@ async def get_or_create_room_for_device(device_id, identity, specified_room_id=N
 
                 conn.commit()
 
-                # 如果内存中不存在房间，则初始化
-                if room_id not in rooms:
-                    rooms[room_id] = {}
-
                 logger.info(f"Device {device_id} joined specified room {room_id}")
                 return room_id, is_new_device, "joined_existing"
             else:
@@ -76,10 +79,8 @@ async def get_or_create_room_for_device(device_id, identity, specified_room_id=N
         device = cursor.fetchone()
 
         if device and device['last_room_id']:
-            # 设备存在并且有一个房间，检查房间是否存在于内存中
+            # 设备存在并且有一个房间
             room_id = device['last_room_id']
-            if room_id not in rooms:
-                rooms[room_id] = {}
 
             # 更新设备的最后连接时间和身份
             cursor.execute(
@@ -116,24 +117,131 @@ async def get_or_create_room_for_device(device_id, identity, specified_room_id=N
 
             conn.commit()
 
-            # 在内存中初始化房间
-            rooms[new_room_id] = {}
-
             logger.info(f"Created new room {new_room_id} for device {device_id}")
             return new_room_id, (not device), "created_new"
 
-    except Error as e:
-        logger.error(f"Database error in get_or_create_room: {e}")
-        # 数据库失败时的回退到仅内存房间
-        new_room_id = generate_room_id()
-        if new_room_id not in rooms:
-            rooms[new_room_id] = {}
-        return new_room_id, True, "error"
+    except Error:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def lookup_device(device_id, specified_room_id=None):
+    """
+    只读查询设备记录和指定房间（在数据库线程池中执行）。
+    返回 device_exists, last_room_id, room_exists
+    """
+    conn = db_manager.get_connection()
+    if not conn:
+        raise db_manager.DatabaseUnavailable("Database connection pool not initialized")
+
+    cursor = conn.cursor(dictionary=True)
+    try:
+        cursor.execute("SELECT last_room_id FROM devices WHERE device_id = %s", (device_id,))
+        device = cursor.fetchone()
+
+        room_exists = False
+        if specified_room_id:
+            cursor.execute("SELECT room_id FROM rooms WHERE room_id = %s", (specified_room_id,))
+            room_exists = cursor.fetchone() is not None
+
+        return device is not None, device['last_room_id'] if device else None, room_exists
     finally:
-        if 'cursor' in locals():
-            cursor.close()
-        if 'conn' in locals():
-            conn.close()
+        cursor.close()
+        conn.close()
+
+
+async def resolve_room_degraded(device_id, identity, specified_room_id=None, db_reachable=True):
+    """
+    降级模式下分配房间：优先使用缓存的设备→房间映射，缓存没有时在数据库可达时只读查询设备记录。
+    设备和房间的写入进入spool；无法确认设备原有房间时拒绝分配，不改写其记录。
+    返回 room_id, is_new_device, room_status
+    """
+    # 缓存无法回答时才查询数据库
+    device = None
+    needs_lookup = (specified_room_id not in rooms) if specified_room_id else (device_id not in device_rooms)
+    if needs_lookup and db_reachable:
+        try:
+            device = await db_manager.run(lookup_device, device_id, specified_room_id)
+        except (db_manager.DatabaseUnavailable, Error) as e:
+            logger.warning(f"Could not look up device {device_id} in degraded mode: {e}")
+
+    is_new_device = device is not None and not device[0]
+
+    if specified_room_id:
+        if specified_room_id not in rooms:
+            if device is None:
+                logger.warning(f"Cannot verify room {specified_room_id} while database is unavailable")
+                return None, None, "room_unavailable"
+            if not device[2]:
+                logger.warning(f"Specified room {specified_room_id} does not exist")
+                return None, None, "room_not_found"
+
+        # 设备主动加入指定房间，与正常路径一样更新其最后所在房间
+        room_id = specified_room_id
+        room_status = "joined_existing"
+        statements = [(UPSERT_DEVICE_SQL, (device_id, room_id, identity, db_manager.EVENT_TIME, db_manager.EVENT_TIME))]
+    elif device_id in device_rooms or (device is not None and device[1]):
+        room_id = device_rooms.get(device_id) or device[1]
+        room_status = "reconnected"
+        statements = [(
+            "UPDATE devices SET last_connected_at = %s, last_identity = %s WHERE device_id = %s",
+            (db_manager.EVENT_TIME, identity, device_id)
+        )]
+    elif device is not None:
+        # 已确认设备没有房间，创建新房间
+        room_id = generate_room_id()
+        while room_id in rooms:
+            room_id = generate_room_id()
+        room_status = "created_new"
+        statements = [
+            ("INSERT IGNORE INTO rooms (room_id, created_at) VALUES (%s, %s)", (room_id, db_manager.EVENT_TIME)),
+            (UPSERT_DEVICE_SQL, (device_id, room_id, identity, db_manager.EVENT_TIME, db_manager.EVENT_TIME))
+        ]
+    else:
+        logger.warning(f"Cannot look up room of device {device_id} while database is unavailable")
+        return None, None, "room_unavailable"
+
+    db_manager.spool(statements)
+
+    if room_id not in rooms:
+        rooms[room_id] = {}
+    device_rooms[device_id] = room_id
+
+    logger.warning(f"Degraded mode: device {device_id} assigned to room {room_id} ({room_status})")
+    return room_id, is_new_device, room_status
+
+
+async def get_or_create_room_for_device(device_id, identity, specified_room_id=None):
+    """
+    获取设备的现有房间或创建新房间（如果设备是首次连接）。
+    如果提供了specified_room_id，则加入该房间。
+    数据库不可用时使用缓存的设备→房间映射降级处理。
+    返回 room_id, is_new_device, room_status
+    """
+    # 仍有待重放的写入时数据库中的设备记录可能过期，使用降级路径以保持房间归属
+    db_reachable = True
+    if not db_manager.spool_pending():
+        try:
+            room_id, is_new_device, room_status = await db_manager.run(
+                resolve_room, device_id, identity, specified_room_id
+            )
+        except db_manager.DatabaseUnavailable as e:
+            logger.warning(f"Database unavailable in get_or_create_room: {e}")
+            db_reachable = False
+        except Error as e:
+            logger.error(f"Database error in get_or_create_room: {e}")
+        else:
+            if room_id:
+                # 如果内存中不存在房间，则初始化
+                if room_id not in rooms:
+                    rooms[room_id] = {}
+                device_rooms[device_id] = room_id
+            return room_id, is_new_device, room_status
+
+    return await resolve_room_degraded(device_id, identity, specified_room_id, db_reachable)
 
 
 def get_room_clients(room_id, exclude_client_id=None):
@@ -0,0 +1,241 @@
+"""
+db_manager 容错行为测试：熔断器状态转换、超时写入的后续处理以及spool重放。
+使用桩写入操作代替真实数据库，spool文件写入临时目录。
+"""
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from mysql.connector import OperationalError
+
+import db_manager
+
+
+class BlockedCall:
+    """阻塞到 release() 为止的桩调用"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.fail = False
+
+    def release(self, fail=False):
+        self.fail = fail
+        self.event.set()
+
+
+class FakeDatabase:
+    """
+    桩数据库写入：每次调用依次取出 outcomes 中的结果，
+    "ok" 成功、"fail" 抛出连接错误、BlockedCall 阻塞到被放行；用完后总是成功。
+    记录成功写入的第一个参数。
+    """
+
+    def __init__(self):
+        self.executed = []
+        self.outcomes = []
+
+    def execute_statements(self, statements):
+        outcome = self.outcomes.pop(0) if self.outcomes else "ok"
+        if isinstance(outcome, BlockedCall):
+            outcome.event.wait(5)
+            outcome = "fail" if outcome.fail else "ok"
+        if outcome == "fail":
+            raise OperationalError(msg="database is down")
+        self.executed.append(statements[0][1][0])
+        return [len(self.executed)] * len(statements)
+
+
+def statement(value):
+    """构造一组只含一条语句的写入，value 用于区分写入顺序"""
+    return [("INSERT INTO messages (message_content) VALUES (%s)", (value,))]
+
+
+class ResilienceTestCase(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.spool_path = os.path.join(self.tempdir.name, "db_spool.jsonl")
+        self.database = FakeDatabase()
+        self.blocked_calls = []
+
+        patches = [
+            mock.patch.dict(db_manager.DB_RESILIENCE_CONFIG, {
+                "call_timeout": 0.1,
+                "slow_call_threshold": 1.0,
+                "failure_threshold": 3,
+                "reset_timeout": 0.2,
+                "spool_path": self.spool_path
+            }),
+            mock.patch.dict(db_manager.breaker, {
+                "state": "closed",
+                "failures": 0,
+                "opened_at": 0.0,
+                "probing": False,
+                "trips": 0
+            }),
+            mock.patch.object(db_manager, "execute_statements", self.database.execute_statements),
+            mock.patch.object(db_manager, "replaying", False)
+        ]
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(self.tempdir.cleanup)
+        self.addCleanup(self.release_blocked_calls)
+
+        db_manager.inflight_writes.clear()
+        db_manager.queued_spool_writes.clear()
+
+    def block(self):
+        """让下一次数据库调用阻塞，返回用于放行的 BlockedCall"""
+        call = BlockedCall()
+        self.blocked_calls.append(call)
+        self.database.outcomes.append(call)
+        return call
+
+    def release_blocked_calls(self):
+        for call in self.blocked_calls:
+            call.event.set()
+
+    async def drain_spool(self):
+        """等待已提交的spool文件操作完成"""
+        await asyncio.get_running_loop().run_in_executor(db_manager.spool_executor, lambda: None)
+
+    async def wait_for_inflight(self):
+        """等待超时写入完成并处理其结果"""
+        for _ in range(200):
+            if not db_manager.inflight_writes:
+                break
+            await asyncio.sleep(0.01)
+        self.assertFalse(db_manager.inflight_writes)
+        await self.drain_spool()
+
+    def read_values(self, path):
+        """读取spool文件中每组写入的区分值"""
+        with open(path, encoding="utf-8") as f:
+            return [json.loads(line)[0][1][0] for line in f if line.strip()]
+
+    async def open_breaker(self):
+        self.database.outcomes.extend(["fail"] * 3)
+        for _ in range(3):
+            with self.assertRaises(db_manager.DatabaseUnavailable):
+                await db_manager.run(db_manager.execute_statements, statement(0))
+        self.assertEqual(db_manager.get_breaker_state(), "open")
+
+    async def test_breaker_opens_half_opens_and_closes(self):
+        await self.open_breaker()
+
+        # 熔断期间不调用数据库
+        with self.assertRaises(db_manager.DatabaseUnavailable):
+            await db_manager.run(db_manager.execute_statements, statement(1))
+        self.assertEqual(self.database.executed, [])
+
+        # 到达探测时间后只放行一个探测调用
+        await asyncio.sleep(0.25)
+        call = self.block()
+        probe = asyncio.create_task(db_manager.run(db_manager.execute_statements, statement(2)))
+        await asyncio.sleep(0.02)
+        self.assertEqual(db_manager.get_breaker_state(), "half_open")
+        with self.assertRaises(db_manager.DatabaseUnavailable):
+            await db_manager.run(db_manager.execute_statements, statement(3))
+
+        call.release()
+        await probe
+        self.assertEqual(db_manager.get_breaker_state(), "closed")
+        self.assertEqual(self.database.executed, [2])
+
+    async def test_failed_probe_reopens_breaker(self):
+        await self.open_breaker()
+        await asyncio.sleep(0.25)
+
+        self.database.outcomes.append("fail")
+        with self.assertRaises(db_manager.DatabaseUnavailable):
+            await db_manager.run(db_manager.execute_statements, statement(1))
+        self.assertEqual(db_manager.get_breaker_state(), "open")
+        self.assertFalse(db_manager.breaker["probing"])
+
+    async def test_timed_out_write_completing_late_is_not_spooled(self):
+        call = self.block()
+        self.assertIsNone(await db_manager.write(statement(1)))
+        self.assertEqual(len(db_manager.inflight_writes), 1)
+        self.assertTrue(db_manager.spool_pending())
+
+        call.release()
+        await self.wait_for_inflight()
+
+        self.assertEqual(self.database.executed, [1])
+        self.assertFalse(db_manager.spool_pending())
+        self.assertEqual(os.listdir(self.tempdir.name), [])
+
+    async def test_timed_out_write_failing_late_is_replayed_first(self):
+        call = self.block()
+        await db_manager.write(statement(1))
+
+        # 超时写入尚未完成时，后续写入进入普通spool
+        await db_manager.write(statement(2))
+        await self.drain_spool()
+        self.assertEqual(self.read_values(self.spool_path), [2])
+
+        # 超时写入最终失败，进入单独的追加文件
+        call.release(fail=True)
+        await self.wait_for_inflight()
+        self.assertEqual(self.read_values(db_manager.late_path()), [1])
+
+        self.assertEqual(await db_manager.replay_spool(), 2)
+        self.assertEqual(self.database.executed, [1, 2])
+        self.assertFalse(db_manager.spool_pending())
+
+    async def test_replay_pauses_and_resumes(self):
+        for value in (1, 2, 3):
+            db_manager.spool(statement(value))
+        await self.drain_spool()
+
+        # 第一组写入成功，第二组失败时暂停并保留未重放的部分
+        self.database.outcomes.extend(["ok", "fail"])
+        self.assertEqual(await db_manager.replay_spool(), 1)
+        self.assertEqual(self.read_values(db_manager.replay_path()), [2, 3])
+        self.assertTrue(db_manager.spool_pending())
+
+        # 暂停期间的新写入排在未重放部分之后
+        db_manager.spool(statement(4))
+        await self.drain_spool()
+
+        self.assertEqual(await db_manager.replay_spool(), 3)
+        self.assertEqual(self.database.executed, [1, 2, 3, 4])
+        self.assertFalse(db_manager.spool_pending())
+
+    async def test_replay_skipped_while_breaker_open(self):
+        db_manager.spool(statement(1))
+        await self.drain_spool()
+        await self.open_breaker()
+
+        self.assertEqual(await db_manager.replay_spool(), 0)
+        self.assertTrue(os.path.exists(self.spool_path))
+        self.assertFalse(os.path.exists(db_manager.replay_path()))
+
+    async def test_replay_skips_malformed_lines(self):
+        with open(self.spool_path, "w", encoding="utf-8") as f:
+            f.write(json.dumps(statement(1)) + "\n")
+            f.write('{"not": "statements"}\n')
+            # 追加中途崩溃留下的残行，没有换行符
+            f.write('[["INSERT INTO messages')
+        db_manager.spool(statement(2))
+        await self.drain_spool()
+
+        self.assertEqual(await db_manager.replay_spool(), 2)
+        self.assertEqual(self.database.executed, [1, 2])
+        self.assertFalse(db_manager.spool_pending())
+
+    async def test_spooled_write_keeps_event_time(self):
+        db_manager.breaker.update({"state": "open", "opened_at": float("inf")})
+        await db_manager.write([("INSERT INTO room_queries (queried_at) VALUES (%s)", (db_manager.EVENT_TIME,))])
+        await self.drain_spool()
+
+        self.assertRegex(self.read_values(self.spool_path)[0], r"^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}$")
+
+
+if __name__ == "__main__":
+    unittest.main()